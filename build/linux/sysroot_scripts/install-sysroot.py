@@ -17,14 +17,20 @@
 # pre-built root image. The image will normally need to be rebuilt every time
 # chrome's build dependencies are changed.
 
+import errno
+import glob
 import hashlib
-import platform
+import httplib
+import mmap
+import multiprocessing.pool
 import optparse
 import os
-import re
 import shutil
+import socket
 import subprocess
 import sys
+import time
+import urllib2
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(os.path.dirname(SCRIPT_DIR)))
@@ -36,6 +42,11 @@ import gyp_environment
 URL_PREFIX = 'https://commondatastorage.googleapis.com'
 URL_PATH = 'chrome-linux-sysroot/toolchain'
 
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_TIMEOUT = 30
+ONE_YEAR = 365 * 24 * 60 * 60
+STALE_CACHE_DOWNLOAD_AGE = 60 * 60
+
 SYSROOTS = {
     ('Wheezy', 'amd64'): {
         'Revision' : 'e964581657e61f47a74b7e2e34e33744ac53d5a6',
@@ -82,18 +93,163 @@ class Error(Exception):
   pass
 
 
+def NewSha1():
+  """Returns a sha1 hasher for checking tarball integrity.
+
+  The hash only guards against corrupt downloads, so on Python 3.9+ it is
+  marked as not security-related, which keeps FIPS-mode builds from
+  rejecting it.
+  """
+  try:
+    return hashlib.new('sha1', usedforsecurity=False)
+  except TypeError:
+    # Python 2 and Python 3 before 3.9 don't accept usedforsecurity.
+    return hashlib.sha1()
+
+
 def GetSha1(filename):
-  sha1 = hashlib.sha1()
+  sha1 = NewSha1()
   with open(filename, 'rb') as f:
+    # Hash through a read-only mapping so the kernel can read ahead and we
+    # avoid allocating a Python string per chunk.  mmap fails on empty files
+    # and when the tarball doesn't fit in the address space (32-bit hosts).
+    try:
+      mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError, OverflowError):
+      mapped = None
+    if mapped is not None:
+      try:
+        sha1.update(mapped)
+      finally:
+        mapped.close()
+      return sha1.hexdigest()
     while True:
-      # Read in 1mb chunks, so it doesn't all have to be loaded into memory.
-      chunk = f.read(1024*1024)
+      # Read in 8mb chunks, so it doesn't all have to be loaded into memory.
+      chunk = f.read(8*1024*1024)
       if not chunk:
         break
       sha1.update(chunk)
   return sha1.hexdigest()
 
 
+def DownloadAndExtract(url, sysroot, sha1sum, tarball=None):
+  """Extracts the tarball at |url| into |sysroot|, verifying |sha1sum|.
+
+  The download is piped straight into tar and hashed as it streams past, so
+  the tarball never touches the disk unless |tarball| asks for a copy.
+  Network errors, including ones in the middle of the transfer, restart the
+  download from scratch a few times.  On failure |sysroot| may be partially
+  populated; the caller must discard it.
+  """
+  for attempt in xrange(DOWNLOAD_ATTEMPTS):
+    try:
+      actual_sha1sum, tar_status = _DownloadAndExtractOnce(url, sysroot,
+                                                           tarball)
+      break
+    except (urllib2.URLError, httplib.HTTPException, socket.error) as e:
+      # Like wget, don't retry requests the server rejected outright.
+      rejected = isinstance(e, urllib2.HTTPError) and e.code < 500
+      if rejected or attempt == DOWNLOAD_ATTEMPTS - 1:
+        raise Error('Failed to download %s: %s' % (url, e))
+      # Start over with an empty sysroot.
+      shutil.rmtree(sysroot)
+      os.mkdir(sysroot)
+  if actual_sha1sum != sha1sum:
+    raise Error('Tarball sha1sum is wrong.'
+                'Expected %s, actual: %s' % (sha1sum, actual_sha1sum))
+  if tar_status != 0:
+    raise Error('Failed to extract %s: tar exited with %d' % (url, tar_status))
+
+
+def _DownloadAndExtractOnce(url, sysroot, tarball):
+  """Makes one attempt at DownloadAndExtract.
+
+  Returns a (sha1sum, tar exit status) tuple.
+  """
+  sha1 = NewSha1()
+  response = urllib2.urlopen(url, timeout=DOWNLOAD_TIMEOUT)
+  expected_length = response.info().getheader('Content-Length')
+  tar = subprocess.Popen(['tar', 'xzf', '-', '-C', sysroot],
+                         stdin=subprocess.PIPE)
+  copy = open(tarball, 'wb') if tarball else None
+  extracting = True
+  received = 0
+  try:
+    while True:
+      chunk = response.read(1024*1024)
+      if not chunk:
+        break
+      received += len(chunk)
+      sha1.update(chunk)
+      if copy:
+        copy.write(chunk)
+      if extracting:
+        try:
+          tar.stdin.write(chunk)
+        except IOError as e:
+          if e.errno != errno.EPIPE:
+            raise
+          # tar gave up, most likely because the download is corrupt.  Keep
+          # hashing so that a bad tarball is reported as a sha1 mismatch.
+          extracting = False
+    # httplib silently returns a short body if the connection drops, so
+    # check the length to retry truncated transfers.
+    if expected_length is not None and received != int(expected_length):
+      raise httplib.HTTPException('Connection closed after %d of %s bytes' %
+                                  (received, expected_length))
+  finally:
+    response.close()
+    tar.stdin.close()
+    if copy:
+      copy.close()
+    tar.wait()
+  return sha1.hexdigest(), tar.returncode
+
+
+def GetCachedTarball(sha1sum):
+  """Returns the path of a verified tarball with |sha1sum| in the sysroot cache.
+
+  The cache is enabled by pointing SYSROOT_CACHE at a directory, which is
+  useful on bots and for developers who wipe their sysroots regularly.
+  Returns None if the cache is disabled or doesn't hold the tarball.
+  """
+  cache_dir = os.environ.get('SYSROOT_CACHE')
+  if not cache_dir:
+    return None
+  cached = os.path.join(cache_dir, sha1sum)
+  if os.path.exists(cached) and GetSha1(cached) == sha1sum:
+    return cached
+  return None
+
+
+def GetCacheDownloadPath(sha1sum):
+  """Returns a temporary path in the sysroot cache to download |sha1sum| to.
+
+  Returns None if the cache is disabled.  Once the download is verified it
+  should be renamed to |sha1sum|; the private name keeps other checkouts
+  populating the same cache from seeing a partial tarball.
+  """
+  cache_dir = os.environ.get('SYSROOT_CACHE')
+  if not cache_dir:
+    return None
+  if not os.path.isdir(cache_dir):
+    try:
+      os.makedirs(cache_dir)
+    except OSError:
+      if not os.path.isdir(cache_dir):
+        raise
+  # Remove downloads abandoned by killed processes.  Downloads still in
+  # progress keep their mtime fresh, so only old files are touched.
+  for stale in glob.glob(os.path.join(cache_dir, '%s.*.tmp' % sha1sum)):
+    try:
+      if time.time() - os.path.getmtime(stale) > STALE_CACHE_DOWNLOAD_AGE:
+        os.remove(stale)
+    except OSError:
+      # Already removed by another process.
+      pass
+  return os.path.join(cache_dir, '%s.%d.tmp' % (sha1sum, os.getpid()))
+
+
 def DetectHostArch():
   # Figure out host arch using build/detect_host_arch.py and
   # set target_arch to host arch
@@ -153,16 +309,16 @@ def InstallDefaultSysroots(host_arch):
   flipping things back and forth and whether the sysroots have been downloaded
   or not.
   """
-  InstallDefaultSysrootForArch(host_arch)
+  sysroots = [GetDefaultSysrootForArch(host_arch)]
 
   if host_arch == 'amd64':
-    InstallDefaultSysrootForArch('i386')
+    sysroots.append(GetDefaultSysrootForArch('i386'))
 
   # Desktop Chromium OS builds require the precise sysroot.
   # TODO(thomasanderson): only download this when the GN arg target_os
   # == 'chromeos', when the functionality to perform the check becomes
   # available.
-  InstallSysroot('Precise', 'amd64')
+  sysroots.append(('Precise', 'amd64'))
 
   # Finally, if we can detect a non-standard target_arch such as ARM or
   # MIPS, then install the sysroot too.
@@ -170,7 +326,27 @@ def InstallDefaultSysroots(host_arch):
   # architecture.
   target_arch = DetectTargetArch()
   if target_arch and target_arch not in (host_arch, 'i386'):
-    InstallDefaultSysrootForArch(target_arch)
+    sysroots.append(GetDefaultSysrootForArch(target_arch))
+
+  # Each sysroot is an independent download and extraction, so fetch them
+  # concurrently.
+  pool = multiprocessing.pool.ThreadPool(len(sysroots))
+  interrupted = False
+  try:
+    # Under Python 2 a wait without a timeout can't be interrupted by Ctrl-C,
+    # so wait on the async result with an effectively infinite timeout.
+    pool.map_async(lambda sysroot: InstallSysroot(*sysroot),
+                   sysroots).get(ONE_YEAR)
+  except KeyboardInterrupt:
+    interrupted = True
+    pool.terminate()
+    raise
+  finally:
+    # If one install failed, let the others finish (or clean up after
+    # themselves) before the error propagates.
+    if not interrupted:
+      pool.close()
+      pool.join()
 
 
 def main(args):
@@ -198,20 +374,23 @@ def main(args):
 
   return 0
 
-def InstallDefaultSysrootForArch(target_arch):
+def GetDefaultSysrootForArch(target_arch):
   if target_arch == 'amd64':
-    InstallSysroot('Wheezy', 'amd64')
+    return ('Wheezy', 'amd64')
   elif target_arch == 'arm':
-    InstallSysroot('Wheezy', 'arm')
+    return ('Wheezy', 'arm')
   elif target_arch == 'arm64':
-    InstallSysroot('Jessie', 'arm64')
+    return ('Jessie', 'arm64')
   elif target_arch == 'i386':
-    InstallSysroot('Wheezy', 'i386')
+    return ('Wheezy', 'i386')
   elif target_arch == 'mips':
-    InstallSysroot('Wheezy', 'mips')
+    return ('Wheezy', 'mips')
   else:
     raise Error('Unknown architecture: %s' % target_arch)
 
+def InstallDefaultSysrootForArch(target_arch):
+  InstallSysroot(*GetDefaultSysrootForArch(target_arch))
+
 def InstallSysroot(target_platform, target_arch):
   # The sysroot directory should match the one specified in build/common.gypi.
   # TODO(thestig) Consider putting this else where to avoid having to recreate
@@ -232,27 +411,37 @@ def InstallSysroot(target_platform, target_arch):
   if os.path.exists(stamp):
     with open(stamp) as s:
       if s.read() == url:
-        print 'Debian %s %s root image already up to date: %s' % \
-            (target_platform, target_arch, sysroot)
+        # Sysroots may be installed from several threads at once, so emit
+        # each message with a single write to keep lines from interleaving.
+        sys.stdout.write('Debian %s %s root image already up to date: %s\n' %
+                         (target_platform, target_arch, sysroot))
         return
 
-  print 'Installing Debian %s %s root image: %s' % \
-      (target_platform, target_arch, sysroot)
+  sys.stdout.write('Installing Debian %s %s root image: %s\n' %
+                   (target_platform, target_arch, sysroot))
   if os.path.isdir(sysroot):
     shutil.rmtree(sysroot)
   os.mkdir(sysroot)
-  tarball = os.path.join(sysroot, tarball_filename)
-  print 'Downloading %s' % url
-  sys.stdout.flush()
-  sys.stderr.flush()
-  subprocess.check_call(
-      ['wget', '--quiet', '-t', '3', '-O', tarball, url])
-  sha1sum = GetSha1(tarball)
-  if sha1sum != tarball_sha1sum:
-    raise Error('Tarball sha1sum is wrong.'
-                'Expected %s, actual: %s' % (tarball_sha1sum, sha1sum))
-  subprocess.check_call(['tar', 'xf', tarball, '-C', sysroot])
-  os.remove(tarball)
+  cached_tarball = GetCachedTarball(tarball_sha1sum)
+  if cached_tarball:
+    sys.stdout.write('Using cached %s\n' % cached_tarball)
+    subprocess.check_call(['tar', 'xf', cached_tarball, '-C', sysroot])
+  else:
+    sys.stdout.write('Downloading %s\n' % url)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    cache_download = GetCacheDownloadPath(tarball_sha1sum)
+    try:
+      DownloadAndExtract(url, sysroot, tarball_sha1sum, cache_download)
+    except:
+      # Don't leave a partial sysroot or cache entry behind, even on Ctrl-C.
+      if cache_download and os.path.exists(cache_download):
+        os.remove(cache_download)
+      shutil.rmtree(sysroot, ignore_errors=True)
+      raise
+    if cache_download:
+      os.rename(cache_download,
+                os.path.join(os.path.dirname(cache_download), tarball_sha1sum))
 
   with open(stamp, 'w') as s:
     s.write(url)
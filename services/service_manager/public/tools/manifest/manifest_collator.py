@@ -8,9 +8,8 @@
 import argparse
 import json
 import os
-import shutil
+import re
 import sys
-import urlparse
 
 
 # Keys which are completely overridden by manifest overlays
@@ -19,42 +18,72 @@ _MANIFEST_OVERLAY_OVERRIDE_KEYS = [
   "process-group",
 ]
 
-eater_relative = '../../../../../../tools/json_comment_eater'
-eater_relative = os.path.join(os.path.abspath(__file__), eater_relative)
-sys.path.insert(0, os.path.normpath(eater_relative))
-try:
-  import json_comment_eater
-finally:
-  sys.path.pop(0)
+# Matches // and /* */ comments. String literals are matched too, so that
+# comment markers inside them (e.g. in URLs) are kept intact.
+_JSON_COMMENT_RE = re.compile(r'("(?:\\.|[^"\\])*")|//[^\r\n]*|/\*.*?\*/',
+                              re.DOTALL)
 
 
 def ParseJSONFile(filename):
   with open(filename) as json_file:
     try:
-      return json.loads(json_comment_eater.Nom(json_file.read()))
+      return json.loads(_JSON_COMMENT_RE.sub(lambda m: m.group(1) or '',
+                                             json_file.read()))
     except ValueError as e:
       print "%s is not a valid JSON document" % filename
       raise e
 
 
 def MergeDicts(left, right):
-  for k, v in right.iteritems():
-    if k not in left:
-      left[k] = v
-    else:
+  # Walk nested dicts with an explicit stack rather than recursing.
+  pending = [(left, right)]
+  while pending:
+    dst, src = pending.pop()
+    # Most keys are new, so find the overlap with a C-level set operation and
+    # only merge those keys by hand; the rest are inserted with dict.update.
+    shared = set(src).intersection(dst)
+    if not shared:
+      dst.update(src)
+      continue
+    for k in shared:
+      existing, v = dst[k], src[k]
       if isinstance(v, dict):
-        assert isinstance(left[k], dict)
-        MergeDicts(left[k], v)
+        assert isinstance(existing, dict)
+        pending.append((existing, v))
       elif isinstance(v, list):
-        assert isinstance(left[k], list)
-        left[k].extend(v)
+        assert isinstance(existing, list)
+        existing.extend(v)
       else:
-        raise "Refusing to merge conflicting non-collection values."
+        raise TypeError("Refusing to merge conflicting non-collection values.")
+    dst.update((k, v) for k, v in src.items() if k not in shared)
+  return left
+
+
+def MergeCapabilities(left, right):
+  """Merges the |right| capabilities spec into |left|.
+
+  "provided" maps capability names to interface lists, and "required" maps
+  service names to dicts of lists, so both are merged directly without
+  MergeDicts' type dispatch. Any other section falls back to MergeDicts.
+  """
+  for section, value in right.items():
+    if section == "provided":
+      provided = left.setdefault("provided", {})
+      for capability, interfaces in value.items():
+        provided.setdefault(capability, []).extend(interfaces)
+    elif section == "required":
+      required = left.setdefault("required", {})
+      for service, spec in value.items():
+        required_spec = required.setdefault(service, {})
+        for key, entries in spec.items():
+          required_spec.setdefault(key, []).extend(entries)
+    else:
+      MergeDicts(left, {section: value})
   return left
 
 
 def MergeManifestOverlay(manifest, overlay):
-  MergeDicts(manifest["capabilities"], overlay["capabilities"])
+  MergeCapabilities(manifest["capabilities"], overlay["capabilities"])
 
   if "services" in overlay:
     if "services" not in manifest:
@@ -87,18 +116,17 @@ def main():
                      "match name '%s' specified in manifest." %
                      (args.name, service_path))
 
-  services = []
-  for child in children:
-    services.append(ParseJSONFile(child))
-
-  if len(services) > 0:
+  services = [ParseJSONFile(child) for child in children]
+  if services:
     parent['services'] = services
 
   for overlay_path in args.overlays:
     MergeManifestOverlay(parent, ParseJSONFile(overlay_path))
 
   with open(args.output, 'w') as output_file:
-    json.dump(parent, output_file)
+    # Serialize in one go with the C encoder and a single write, and skip
+    # the optional whitespace.
+    output_file.write(json.dumps(parent, separators=(',', ':')))
 
   return 0
 